@@ -1,15 +1,57 @@
 import random
 import re
-from itertools import combinations, chain
-from queue import Queue
+import sys
+from collections import deque
+from functools import lru_cache
+from itertools import combinations, chain, islice
+from multiprocessing import Pool
 
 from tree import utils
 from tree_sitter import Language, Parser
 
 from tree.desensitizer import desensitize, formalize
 
+# compiled once instead of per identifier | per representation
+_CAMEL_RE = re.compile(r'.+?(?:(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])|$)')
+_PAREN_SPLIT_RE = re.compile(r'[(|)]')
+# parsers are reused by the documents of the same language (one per process)
+_PARSERS = {}
+# middles of UD leaf paths by (prefix_len, suffix_len)
+_UD_MIDDLES = {}
+# tree style -> (syntax, hierarchy), root paths are empty for the other tree styles
+_TREE_STYLES = {
+    'AST': (True, False),  # abstract syntax tree
+    'SPT': (False, False),  # simplified parse tree
+    'HST': (True, True),  # hierarchy syntax tree (binary syntax tree)
+    'HPT': (False, True),  # hierarchy parse tree (binary parse tree)
+}
+
+
+# terminal tokens repeat a lot across a corpus (keywords, self, i, ...), so the pure
+# functions applied to terminal values are cached (per process)
+# non-terminal values are whole first lines and nearly unique, so desensitize is not cached
+@lru_cache(maxsize=200_000)
+def _formalize(token):
+    return formalize(token)
+
+
+@lru_cache(maxsize=200_000)
+def tokenize(term):
+    def camel_case_split(identifier):
+        matches = _CAMEL_RE.finditer(identifier)
+        return [m.group(0) for m in matches]
+
+    blocks = []
+    for underscore_block in term.split('_'):
+        blocks.extend(camel_case_split(underscore_block))
+    return '|'.join(block.lower() for block in blocks)
+
 
 class TSNode:
+    # trees have tens of thousands of nodes, slots save the per-node __dict__
+    __slots__ = ('type', 'value', 'mark', 'eldest', 'guardian', 'left_child', 'right_sibling', 'parent', 'children',
+                 '_ast_path', '_spt_path', '_hpt_anchor', '_hpt_value')
+
     def __init__(self):
         self.type = None
         self.value = None
@@ -23,61 +65,80 @@ class TSNode:
         self.right_sibling = None
         # for the form of multi-way tree
         self.parent = None
-        self.children = []
+        # allocated by TS.traverse for non-terminals only
+        self.children = None
+        # cached by TS.traverse: ancestors from the root down to the parent (without marks)
+        self._ast_path = None
+        self._spt_path = None
+        # the nearest ancestor typed expression_statement (for HST | HPT)
+        self._hpt_anchor = None
+        self._hpt_value = None
 
     def gen_root_path(self, tree_style='SPT'):
-        ptr = self
-        root_path = []
-        hpt_ptr = None
-        while ptr.parent:
-            ptr = ptr.parent
-            # AST | SPT || HST | HPT
-            if tree_style == 'AST':
-                # abstract syntax tree
-                root_path.append(ptr.type + self.mark)
-            elif tree_style == 'SPT':
-                # simplified parse tree
-                root_path.append(ptr.value + self.mark)
-            elif tree_style == 'HST':
-                # binary syntax tree
-                # hierarchy syntax tree
-                root_path.append(ptr.type + self.mark)
-                if not hpt_ptr and ptr.type == 'expression_statement':
-                    hpt_ptr = ptr
-                    root_path = []
-            elif tree_style == 'HPT':
-                # binary parse tree
-                # hierarchy parse tree
-                root_path.append(ptr.value + self.mark)
-                if not hpt_ptr and ptr.type == 'expression_statement':
-                    hpt_ptr = ptr
-                    root_path = []
-        root_path = list(reversed(root_path))
-        value = self.value
-        if hpt_ptr:
+        return self.gen_styled_root_path(_TREE_STYLES.get(tree_style))
+
+    def gen_styled_root_path(self, style):
+        # style is (syntax, hierarchy) from _TREE_STYLES, resolved once by the caller
+        # ancestors are cached by TS.traverse, so we never walk back to the root here
+        if style is None:
+            return [], self.value + self.mark
+        syntax, hierarchy = style
+        anchor = self._hpt_anchor if hierarchy else None
+        node = anchor or self
+        # ancestors are tagged with the mark of this node (a fresh list, the cache stays intact)
+        root_path = [ancestor + self.mark for ancestor in (node._ast_path if syntax else node._spt_path)]
+        value = anchor.gen_hpt_value() if anchor else self.value
+        return root_path, value + self.mark
+
+    def gen_hpt_value(self):
+        # shared by all the terminals under the same expression_statement
+        if self._hpt_value is None:
             values = []
-            q = Queue()
-            q.put(hpt_ptr)
-            while not q.empty():
-                ptr = q.get()
+            q = deque()
+            q.append(self)
+            while q:
+                ptr = q.popleft()
                 if ptr.type == 'identifier':
                     values.extend(ptr.value.split('|'))
-                for child in ptr.children:
-                    q.put(child)
-            value = '|'.join(values)
-        return root_path, value + self.mark
+                for child in ptr.children or ():
+                    q.append(child)
+            self._hpt_value = '|'.join(values)
+        return self._hpt_value
 
     def gen_sbt(self):
-        subtree_sbt = ''.join(child.gen_sbt() for child in self.children)
+        out = []
+        self._gen_sbt_into(out)
+        return ''.join(out)
+
+    def _gen_sbt_into(self, out):
         # we prefer self.value to self.type
-        # return f'{self.type}({subtree_sbt}){self.type}'
-        return f'{self.value}({subtree_sbt}){self.value}'
+        # out += [self.type, '(', ..., ')', self.type]  (children in the middle)
+        out.append(self.value)
+        out.append('(')
+        for child in self.children or ():
+            child._gen_sbt_into(out)
+        out.append(')')
+        out.append(self.value)
 
     def gen_lcrs(self):
-        left_lcrs = self.left_child.gen_lcrs() if self.left_child else ''
-        right_lcrs = self.right_sibling.gen_lcrs() if self.right_sibling else ''
         # we prefer mid-order traversal instead of SBT
-        return f'({left_lcrs}({self.value}){right_lcrs})'
+        # iterative, because LC-RS trees grow deep along the right siblings
+        out = []
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, TSNode):
+                # emits ({left_lcrs}({value}){right_lcrs})
+                stack.append(')')
+                if item.right_sibling:
+                    stack.append(item.right_sibling)
+                stack.extend((')', item.value, '('))
+                if item.left_child:
+                    stack.append(item.left_child)
+                stack.append('(')
+            else:
+                out.append(item)
+        return ''.join(out)
 
 
 class TS:
@@ -100,13 +161,17 @@ class TS:
         #     'vendor/tree-sitter-ruby',
         #   ]
         # )
-        parser = Parser()
-        # Load the languages into your app as Language objects:
-        # ('go', 'java', 'javascript', 'php', 'python', 'ruby')
-        parser.set_language(Language(csn_so, language))
-        tree = parser.parse(code.encode())
-        code_lines = code.split('\n')
-        self.root, self.terminals, self.num_eldest = self.traverse(tree, code_lines)
+        parser = _PARSERS.get(language)
+        if parser is None:
+            parser = Parser()
+            # Load the languages into your app as Language objects:
+            # ('go', 'java', 'javascript', 'php', 'python', 'ruby')
+            parser.set_language(Language(csn_so, language))
+            _PARSERS[language] = parser
+        # tree-sitter reports byte offsets, so tokens are sliced from the encoded code
+        self._code = code.encode()
+        tree = parser.parse(self._code)
+        self.root, self.terminals, self.num_eldest = self.traverse(tree)
         self.terminal_nodes = list()
         self.nonterminal_nodes = []
         self.leafpath_terminal_nodes = list()
@@ -118,66 +183,95 @@ class TS:
             print(f'{"@" * 9}code\n{code}')
             print(f'{"@" * 9}sexp\n{tree.root_node.sexp()}')
 
-    def traverse(self, tree, code_lines):
-        q = Queue()
+    def traverse(self, tree):
+        # a pre-order walk with the TS cursor, which never builds the lists of TS children
+        # terminals are therefore listed in source order (not BFS order), which is the order of root paths
+        cursor = tree.walk()
         root = TSNode()
         terminals = []
         eldest_counter = 0
-        q.put((root, tree.root_node))
-        while not q.empty():
+        lhs = root
+        while True:
             # lhs is the node we defined
             # rhs is the node TS supplied
-            lhs, rhs = q.get()
-            lhs.type = str(rhs.type).lower().strip()
-            lhs.value = self.query_token(rhs, code_lines)
+            rhs = cursor.node
+            # types and terminal values repeat a lot across nodes, interning makes them shared
+            lhs.type = sys.intern(str(rhs.type).lower().strip())
+            lhs.value = self.query_token(rhs)
             # mark is "@1~4~1~7" if start_point == (1, 4) and end_point == (1, 7)
-            lhs.mark += '~'.join(str(index) for index in rhs.start_point + rhs.end_point)
-            if rhs.children:
+            start_point, end_point = rhs.start_point, rhs.end_point
+            lhs.mark = f'@{start_point[0]}~{start_point[1]}~{end_point[0]}~{end_point[1]}'
+            # cache root paths top-down, the parent has been visited already
+            parent = lhs.parent
+            if parent:
+                lhs._ast_path = parent._ast_path + [parent.type]
+                lhs._spt_path = parent._spt_path + [parent.value]
+                lhs._hpt_anchor = parent if parent.type == 'expression_statement' else parent._hpt_anchor
+            else:
+                lhs._ast_path = []
+                lhs._spt_path = []
+            if cursor.goto_first_child():
                 eldest_counter += 1
                 # non-terminals
+                # not interned: non-terminal values are whole first lines and nearly unique
                 lhs.value = desensitize(lhs.value)
-                left_sibling = None
-                for rhs_child in rhs.children:
-                    lhs_child = TSNode()
-                    # for the form of LC-RS tree
-                    if left_sibling:
-                        lhs_child.guardian = left_sibling
-                        left_sibling.right_sibling = lhs_child
-                    else:
-                        lhs_child.guardian = lhs
-                        lhs.left_child = lhs_child
-                    left_sibling = lhs_child
-                    # for the form of multi-way tree
-                    lhs_child.parent = lhs
-                    lhs.children.append(lhs_child)
-                    q.put((lhs_child, rhs_child))
-            else:
-                # terminals
-                lhs.value = self.tokenize(lhs.value)
-                lhs.value = formalize(lhs.value)
-                terminals.append(lhs)
-
-        return root, terminals, eldest_counter
+                lhs.children = []
+                lhs_child = TSNode()
+                # for the form of LC-RS tree
+                lhs_child.guardian = lhs
+                lhs.left_child = lhs_child
+                # for the form of multi-way tree
+                lhs_child.parent = lhs
+                lhs.children.append(lhs_child)
+                lhs = lhs_child
+                continue
+            # terminals
+            lhs.value = tokenize(lhs.value)
+            lhs.value = sys.intern(_formalize(lhs.value))
+            terminals.append(lhs)
+            # go up until there is a right sibling to visit
+            while not cursor.goto_next_sibling():
+                if not cursor.goto_parent():
+                    return root, terminals, eldest_counter
+                lhs = lhs.parent
+            lhs_sibling = TSNode()
+            # for the form of LC-RS tree
+            lhs_sibling.guardian = lhs
+            lhs.right_sibling = lhs_sibling
+            # for the form of multi-way tree
+            lhs_sibling.parent = lhs.parent
+            lhs.parent.children.append(lhs_sibling)
+            lhs = lhs_sibling
 
     def gen_root_paths(self):
         threshold = 20
-        root_paths_1 = list()  # number of qualified leaf node 1
-        root_paths_0 = list()  # number of qualified leaf node 0
+        # reservoirs keep at most threshold root paths, counters keep the number seen
+        root_paths_1, num_root_paths_1 = list(), 0  # number of qualified leaf node 1
+        root_paths_0, num_root_paths_0 = list(), 0  # number of qualified leaf node 0
+        # the tree style is resolved once instead of once per terminal, and the cached fields
+        # are read inline (same as TSNode.gen_styled_root_path) to save a call per terminal
+        style = _TREE_STYLES.get(self.tree_style)
+        syntax, hierarchy = style or (False, False)
         for terminal in self.terminals:
-            root_path, value = terminal.gen_root_path(self.tree_style)
+            mark = terminal.mark
+            if style is None:
+                root_path, value = [], terminal.value + mark
+            else:
+                anchor = terminal._hpt_anchor if hierarchy else None
+                node = anchor or terminal
+                root_path = [ancestor + mark for ancestor in (node._ast_path if syntax else node._spt_path)]
+                value = (anchor.gen_hpt_value() if anchor else terminal.value) + mark
             self.terminal_nodes.append(value)
             self.nonterminal_nodes.extend(root_path)
             if terminal.type == 'identifier':
                 if root_path and value:
                     if len(value) > 1:
-                        root_paths_1.append((root_path, value))
+                        num_root_paths_1 = reservoir_sample(root_paths_1, num_root_paths_1, (root_path, value), threshold)
                     else:
-                        root_paths_0.append((root_path, value))
+                        num_root_paths_0 = reservoir_sample(root_paths_0, num_root_paths_0, (root_path, value), threshold)
         root_paths = root_paths_1
         margin = threshold - len(root_paths)
-        if margin < 0:
-            root_paths = random.sample(root_paths, threshold)
-        elif margin > 0:
+        if margin > 0:
             margin = min(margin, len(root_paths_0))
             root_paths_0 = random.sample(root_paths_0, margin)
             root_paths.extend(root_paths_0)
@@ -193,44 +287,55 @@ class TS:
         path_width_threshold = 2
         path_length_threshold = 8
         root_paths = self.gen_root_paths()
-        cases = combinations(iterable=root_paths, r=2)
-        leaf_paths_2 = list()  # number of qualified leaf node 2
-        leaf_paths_1 = list()  # number of qualified leaf node 1
-        leaf_paths_0 = list()  # number of qualified leaf node 0
-        for (u_path, u_value), (v_path, v_value) in cases:
-            prefix, lca, suffix = self.merge_paths(u_path, v_path)
-            prefix_len = len(prefix)
-            suffix_len = len(suffix)
-            if threshold <= len(leaf_paths_2):
-                if len(u_value) <= 1 or len(v_value) <= 1:
+        # cheap per root path info, so that rejected pairs never reach merge_paths
+        lengths = [len(root_path) for root_path, _ in root_paths]
+        qualified = [len(value) > 1 for _, value in root_paths]
+        path_style = self.path_style
+        # reservoirs keep at most threshold leaf paths, counters keep the number seen
+        leaf_paths_2, num_leaf_paths_2 = list(), 0  # number of qualified leaf node 2
+        leaf_paths_1, num_leaf_paths_1 = list(), 0  # number of qualified leaf node 1
+        leaf_paths_0, num_leaf_paths_0 = list(), 0  # number of qualified leaf node 0
+        for u, v in combinations(range(len(root_paths)), 2):
+            if threshold <= num_leaf_paths_2:
+                if not qualified[u] or not qualified[v]:
                     continue
-            elif threshold <= len(leaf_paths_2) + len(leaf_paths_1):
-                if len(u_value) <= 1 and len(v_value) <= 1:
+            elif threshold <= num_leaf_paths_2 + num_leaf_paths_1:
+                if not qualified[u] and not qualified[v]:
                     continue
+            # prefix_len - suffix_len == len(u_path) - len(v_path) whatever the lca is
+            if abs(lengths[u] - lengths[v]) > path_width_threshold:
+                continue
+            (u_path, u_value), (v_path, v_value) = root_paths[u], root_paths[v]
+            # the lengths are checked before merge_paths slices prefix and suffix out
+            s = self.common_prefix_len(u_path, v_path)
+            prefix_len = lengths[u] - s
+            suffix_len = lengths[v] - s
             if 1 <= prefix_len and 1 <= suffix_len \
-                    and abs(prefix_len - suffix_len) <= path_width_threshold \
                     and prefix_len + 1 + suffix_len <= path_length_threshold:
+                prefix, lca, suffix = self.merge_paths(u_path, v_path, s)
                 source, target = u_value, v_value
-                if self.path_style == 'L2L':
-                    middle = '|'.join(prefix + [lca] + suffix)
-                elif self.path_style == 'UD':
-                    middle = '|'.join('U' * prefix_len + 'D' * suffix_len)
+                if path_style == 'L2L':
+                    middle = '|'.join(chain(prefix, (lca,), suffix))
+                elif path_style == 'UD':
+                    # it only depends on the lengths, which are bounded by path_length_threshold
+                    ud_key = (prefix_len, suffix_len)
+                    middle = _UD_MIDDLES.get(ud_key)
+                    if middle is None:
+                        middle = _UD_MIDDLES[ud_key] = '|'.join('U' * prefix_len + 'D' * suffix_len)
                 else:
-                    middle = '|U|'.join(prefix) + f'|U|{lca}|D|' + '|D|'.join(suffix)
+                    middle = f"{'|U|'.join(prefix)}|U|{lca}|D|{'|D|'.join(suffix)}"
                 # leaf_path = middle
                 leaf_path = f'{source}|{middle}|{target}'
-                if len(source) > 1 or len(target) > 1:
-                    if len(source) > 1 and len(target) > 1:
-                        leaf_paths_2.append(leaf_path)
+                if qualified[u] or qualified[v]:
+                    if qualified[u] and qualified[v]:
+                        num_leaf_paths_2 = reservoir_sample(leaf_paths_2, num_leaf_paths_2, leaf_path, threshold)
                     else:
-                        leaf_paths_1.append(leaf_path)
+                        num_leaf_paths_1 = reservoir_sample(leaf_paths_1, num_leaf_paths_1, leaf_path, threshold)
                 else:
-                    leaf_paths_0.append(leaf_path)
+                    num_leaf_paths_0 = reservoir_sample(leaf_paths_0, num_leaf_paths_0, leaf_path, threshold)
         leaf_paths = leaf_paths_2
         margin = threshold - len(leaf_paths)
-        if margin < 0:
-            leaf_paths = random.sample(leaf_paths, threshold)
-        elif margin > 0:
+        if margin > 0:
             margin = min(margin, len(leaf_paths_1))
             leaf_paths_1 = random.sample(leaf_paths_1, margin)
             leaf_paths.extend(leaf_paths_1)
@@ -249,35 +354,22 @@ class TS:
         return leaf_paths
 
     def stats(self):
-        # deduplication
-        self.terminal_nodes = list(set(self.terminal_nodes))
-        self.nonterminal_nodes = list(set(self.nonterminal_nodes))
-        self.rootpath_terminal_nodes = list(set(self.rootpath_terminal_nodes))
-        self.rootpath_nonterminal_nodes = list(set(self.rootpath_nonterminal_nodes))
-        self.leafpath_terminal_nodes = list(set(self.leafpath_terminal_nodes))
-        self.leafpath_nonterminal_nodes = list(set(self.leafpath_nonterminal_nodes))
+        # deduplication, both with and without marks in a single pass
+        num_terminal_nodes, self.terminal_nodes = self.dedup_nodes(self.terminal_nodes)
+        num_nonterminal_nodes, self.nonterminal_nodes = self.dedup_nodes(self.nonterminal_nodes)
+        num_rootpath_terminal_nodes, self.rootpath_terminal_nodes = self.dedup_nodes(self.rootpath_terminal_nodes)
+        num_rootpath_nonterminal_nodes, self.rootpath_nonterminal_nodes = self.dedup_nodes(self.rootpath_nonterminal_nodes)
+        num_leafpath_terminal_nodes, self.leafpath_terminal_nodes = self.dedup_nodes(self.leafpath_terminal_nodes)
+        num_leafpath_nonterminal_nodes, self.leafpath_nonterminal_nodes = self.dedup_nodes(self.leafpath_nonterminal_nodes)
         # link_coverage =
         # (num_path_terminal_nodes + num_path_nonterminal_nodes - 1)
         # / (num_terminal_nodes + num_nonterminal_nodes - 1)
-        num_terminal_nodes = len(self.terminal_nodes)
-        num_nonterminal_nodes = len(self.nonterminal_nodes)
-        num_rootpath_terminal_nodes = len(self.rootpath_terminal_nodes)
-        num_rootpath_nonterminal_nodes = len(self.rootpath_nonterminal_nodes)
-        num_leafpath_terminal_nodes = len(self.leafpath_terminal_nodes)
-        num_leafpath_nonterminal_nodes = len(self.leafpath_nonterminal_nodes)
         link_coverage_rootpath = (num_rootpath_terminal_nodes + num_rootpath_nonterminal_nodes - 1) / (num_terminal_nodes + num_nonterminal_nodes - 1)
         link_coverage_leafpath = (num_leafpath_terminal_nodes + num_leafpath_nonterminal_nodes - 1) / (num_terminal_nodes + num_nonterminal_nodes - 1)
 
         # special: link_coverage_lcrs
         link_coverage_lcrs = self.num_eldest / (num_terminal_nodes + num_nonterminal_nodes - 1)
 
-        # deduplication
-        self.terminal_nodes = list(set(self.clean_mark(self.terminal_nodes)))
-        self.nonterminal_nodes = list(set(self.clean_mark(self.nonterminal_nodes)))
-        self.rootpath_terminal_nodes = list(set(self.clean_mark(self.rootpath_terminal_nodes)))
-        self.rootpath_nonterminal_nodes = list(set(self.clean_mark(self.rootpath_nonterminal_nodes)))
-        self.leafpath_terminal_nodes = list(set(self.clean_mark(self.leafpath_terminal_nodes)))
-        self.leafpath_nonterminal_nodes = list(set(self.clean_mark(self.leafpath_nonterminal_nodes)))
         # node_coverage =
         # (num_cleaned_path_terminal_nodes + num_cleaned_path_nonterminal_nodes)
         # / (num_cleaned_terminal_nodes + num_cleaned_nonterminal_nodes)
@@ -293,41 +385,44 @@ class TS:
         return link_coverage_rootpath, link_coverage_leafpath, link_coverage_lcrs, node_coverage_rootpath, node_coverage_leafpath
 
     @staticmethod
-    def clean_mark(nodes):
-        nodes = [node.split('@')[0] for node in nodes]
-        return nodes
-
-    @staticmethod
-    def query_token(node, code_lines):
-        line_start = node.start_point[0]
-        line_end = node.end_point[0]
-        char_start = node.start_point[1]
-        char_end = node.end_point[1]
-
-        if line_start != line_end:
-            return code_lines[line_start][char_start:]
-        else:
-            return code_lines[line_start][char_start:char_end]
+    def dedup_nodes(nodes):
+        # returns the number of unique nodes and the unique nodes cleaned from marks
+        # the mark is cleaned once per unique node (only the part before the first '@' is needed)
+        unique_nodes = set()
+        cleaned_nodes = dict()  # dict keeps the insertion order, unlike set
+        for node in nodes:
+            if node not in unique_nodes:
+                unique_nodes.add(node)
+                cleaned_nodes[node.split('@', 1)[0]] = None
+        return len(unique_nodes), list(cleaned_nodes)
+
+    def query_token(self, node):
+        start = node.start_byte
+        end = node.end_byte
+        if node.start_point[0] != node.end_point[0]:
+            # only the first line of a multi-line node is kept (e.g. the header of a function)
+            end = self._code.find(b'\n', start)
+        return self._code[start:end].decode()
 
     @staticmethod
     def tokenize(term):
-        def camel_case_split(identifier):
-            matches = re.finditer(
-                '.+?(?:(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])|$)',
-                identifier,
-            )
-            return [m.group(0) for m in matches]
-
-        blocks = []
-        for underscore_block in term.split('_'):
-            blocks.extend(camel_case_split(underscore_block))
-        return '|'.join(block.lower() for block in blocks)
+        return tokenize(term)
 
     @staticmethod
-    def merge_paths(u_path, v_path):
-        m, n, s = len(u_path), len(v_path), 0
-        while s < min(m, n) and u_path[s] == v_path[s]:
+    def common_prefix_len(u_path, v_path):
+        # zip stops at the shorter path
+        s = 0
+        for u_node, v_node in zip(u_path, v_path):
+            if u_node != v_node:
+                break
             s += 1
+        return s
+
+    @staticmethod
+    def merge_paths(u_path, v_path, s=None):
+        # s is the length of the common prefix, when the caller has it already
+        if s is None:
+            s = TS.common_prefix_len(u_path, v_path)
 
         prefix = list(reversed(u_path[s:]))
         lca = u_path[s - 1]
@@ -337,22 +432,27 @@ class TS:
 
     def gen_sbt_representation(self):
         sbt_representation = self.root.gen_sbt()
-        sbt_tokens = re.split('[(|)]', sbt_representation)
-        sbt_tokens = list(filter(None, sbt_tokens))
+        sbt_tokens = [token for token in _PAREN_SPLIT_RE.split(sbt_representation) if token]
         return sbt_tokens
 
     def gen_lcrs_representation(self):
-        try:
-            lcrs_representation = self.root.gen_lcrs()
-            lcrs_tokens = re.split('[(|)]', lcrs_representation)
-            lcrs_tokens = list(filter(None, lcrs_tokens))
-        except RecursionError:
-            # in rare cases, LCRS tree grows rather deep
-            print('RecursionError')
-            return self.gen_sbt_representation()
+        lcrs_representation = self.root.gen_lcrs()
+        lcrs_tokens = [token for token in _PAREN_SPLIT_RE.split(lcrs_representation) if token]
         return lcrs_tokens
 
 
+def reservoir_sample(reservoir, counter, item, size):
+    # reservoir sampling (algorithm R), a uniform sample of size items without keeping the others
+    # counter is the number of items seen before this one, and the updated counter is returned
+    if counter < size:
+        reservoir.append(item)
+    else:
+        index = random.randint(0, counter)
+        if index < size:
+            reservoir[index] = item
+    return counter + 1
+
+
 def code2paths(code, language='python', mode='rootpath'):
     ts = TS(code, language)
     paths = []
@@ -378,6 +478,15 @@ def doc2tokens(doc, language, data_type, evaluation=True):
     return tokens
 
 
+def doc2stats(args):
+    language, code = args
+    ts = TS(code, language)
+    # we only invoke ts.gen_leaf_paths()
+    # because ts.gen_root_paths() will be invoked there
+    _ = ts.gen_leaf_paths()
+    return ts.stats()
+
+
 def run_stats(language):
     sum_link_coverage_rootpath = 0.0
     sum_link_coverage_leafpath = 0.0
@@ -388,21 +497,22 @@ def run_stats(language):
     valid_docs = utils.get_csn_corpus(language, 'valid')
     test_docs = utils.get_csn_corpus(language, 'test')
     docs_counter = 0
-    for doc in chain(train_docs, valid_docs, test_docs):
-        language = doc['language']
-        code = doc['code']
-        ts = TS(code, language)
-        # we only invoke ts.gen_leaf_paths()
-        # because ts.gen_root_paths() will be invoked there
-        _ = ts.gen_leaf_paths()
-        # stats
-        link_coverage_rootpath, link_coverage_leafpath, link_coverage_lcrs, node_coverage_rootpath, node_coverage_leafpath = ts.stats()
-        sum_link_coverage_rootpath += link_coverage_rootpath
-        sum_link_coverage_leafpath += link_coverage_leafpath
-        sum_link_coverage_lcrs += link_coverage_lcrs
-        sum_node_coverage_rootpath += node_coverage_rootpath
-        sum_node_coverage_leafpath += node_coverage_leafpath
-        docs_counter += 1
+    # documents are independent, so TS runs in parallel (imap keeps the order of sums deterministic)
+    # the corpus is streamed, so it is fed in bounded batches instead of drained into the task queue
+    docs = chain(train_docs, valid_docs, test_docs)
+    with Pool() as p:
+        while True:
+            args = [(doc['language'], doc['code']) for doc in islice(docs, 4096)]
+            if not args:
+                break
+            for doc_stats in p.imap(doc2stats, args, chunksize=32):
+                link_coverage_rootpath, link_coverage_leafpath, link_coverage_lcrs, node_coverage_rootpath, node_coverage_leafpath = doc_stats
+                sum_link_coverage_rootpath += link_coverage_rootpath
+                sum_link_coverage_leafpath += link_coverage_leafpath
+                sum_link_coverage_lcrs += link_coverage_lcrs
+                sum_node_coverage_rootpath += node_coverage_rootpath
+                sum_node_coverage_leafpath += node_coverage_leafpath
+                docs_counter += 1
     print(f'language={language}')
     avg_link_coverage_rootpath = sum_link_coverage_rootpath / docs_counter
     avg_link_coverage_leafpath = sum_link_coverage_leafpath / docs_counter